@@ -4,16 +4,223 @@ API сервер для автоматической генерации аним
 Запуск: ./venv/bin/python api_server.py
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
+from collections import OrderedDict
+import io
 import json
 import os
-import subprocess
+import re
+import tempfile
+import threading
 from datetime import datetime
 
+import networkx as nx
+import matplotlib
+matplotlib.use('Agg')  # Без GUI
+import matplotlib.pyplot as plt
+
 app = Flask(__name__)
 CORS(app)  # Разрешаем CORS для браузера
 
+OUTPUT_DIR = 'output'
+
+# Граф и пути проекта рядом с info.json — из них рисуются кадры по запросу
+GRAPH_FILE = 'graph.json'
+
+FRAME_FILE_RE = re.compile(r'^frame_(\d+)\.png$')
+
+# Лимит памяти под отрисованные кадры (байты), по умолчанию 64 МБ
+FRAME_CACHE_BYTES = int(os.environ.get('FRAME_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+class FrameCache:
+    """LRU-кэш PNG-кадров, ограниченный суммарным размером в байтах"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+    
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self._items[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.total_bytes -= len(evicted)
+    
+    def drop_project(self, project_name):
+        with self._lock:
+            for key in [k for k in self._items if k[0] == project_name]:
+                self.total_bytes -= len(self._items.pop(key))
+
+
+frame_cache = FrameCache(FRAME_CACHE_BYTES)
+
+# Граф, позиции и пути проектов, для которых уже рисовали кадры
+project_states = {}
+
+# Блокировки проектов: генерация и чтение состояния проекта не пересекаются
+project_locks = {}
+project_locks_lock = threading.Lock()
+
+# pyplot не потокобезопасен, рисуем по одному кадру за раз
+render_lock = threading.Lock()
+
+
+def get_project_lock(project_name):
+    with project_locks_lock:
+        return project_locks.setdefault(project_name, threading.Lock())
+
+
+def write_file_atomic(filepath, data):
+    """Пишет файл через временный, чтобы никто не прочитал его недописанным"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def remove_stale_frames(output_dir, keep):
+    """Удаляет frame_*.png с номерами больше keep (keep=0 — все кадры)"""
+    for filename in os.listdir(output_dir):
+        match = FRAME_FILE_RE.match(filename)
+        if match and int(match.group(1)) > keep:
+            os.remove(os.path.join(output_dir, filename))
+
+
+def build_graph(graph_data):
+    """Создаёт граф и позиции вершин из JSON редактора"""
+    G = nx.DiGraph()
+    edges = [(edge['from'], edge['to']) for edge in graph_data['edges']]
+    G.add_edges_from(edges)
+    
+    pos = {}
+    for node in graph_data['nodes']:
+        label = node['label']
+        x = node['x']
+        y = -node['y']
+        pos[label] = (x, y)
+    
+    return G, pos
+
+
+def build_frames(paths):
+    """Список кадров (манифест) для пошаговой анимации всех путей"""
+    frames = []
+    frame_number = 0
+    for path_idx, path in enumerate(paths, 1):
+        for step in range(1, len(path) + 1):
+            frame_number += 1
+            frames.append({
+                'number': frame_number,
+                'path_index': path_idx,
+                'step': step,
+                'current_path': ' → '.join(path[:step]),
+                'filename': f'frame_{frame_number:04d}.png'
+            })
+    return frames
+
+
+def render_frame(G, pos, paths, frame):
+    """Рисует один кадр и возвращает PNG в виде байтов"""
+    path = paths[frame['path_index'] - 1]
+    step = frame['step']
+    
+    current_path = path[:step]
+    current_edges = list(zip(current_path[:-1], current_path[1:])) if len(current_path) > 1 else []
+    current_edges_set = set(current_edges)
+    
+    with render_lock:
+        plt.figure(figsize=(14, 8))
+        
+        other_edges = [edge for edge in G.edges() if edge not in current_edges_set]
+        other_nodes = [node for node in G.nodes() if node not in current_path]
+        
+        # Рёбра (сначала)
+        if other_edges:
+            nx.draw_networkx_edges(G, pos, edgelist=other_edges,
+                                  edge_color='gray', width=2.5, alpha=0.4,
+                                  arrows=True, arrowsize=20, arrowstyle='->')
+        
+        if current_edges:
+            nx.draw_networkx_edges(G, pos, edgelist=current_edges,
+                                  edge_color='#FF1744', width=5,
+                                  arrows=True, arrowsize=30, arrowstyle='->',
+                                  node_size=1500)
+        
+        # Вершины (поверх)
+        if other_nodes:
+            nx.draw_networkx_nodes(G, pos, nodelist=other_nodes,
+                                  node_color='lightgray', node_size=1500, alpha=0.5)
+        
+        if len(current_path) > 1:
+            intermediate = current_path[:-1]
+            nx.draw_networkx_nodes(G, pos, nodelist=intermediate,
+                                  node_color='orange', node_size=1500,
+                                  edgecolors='#ff8c00', linewidths=3)
+        
+        current_node = current_path[-1]
+        nx.draw_networkx_nodes(G, pos, nodelist=[current_node],
+                              node_color='#ff4500', node_size=1800,
+                              edgecolors='#ff0000', linewidths=4)
+        
+        nx.draw_networkx_labels(G, pos, font_size=16, font_weight='bold', font_color='#333')
+        
+        title = f'Путь {frame["path_index"]}/{len(paths)} | Шаг {step}/{len(path)}: {" → ".join(current_path)}'
+        plt.title(title, fontsize=18, fontweight='bold', pad=20)
+        plt.axis('off')
+        plt.tight_layout()
+        
+        buf = io.BytesIO()
+        plt.savefig(buf, format='png', dpi=150, bbox_inches='tight', facecolor='white')
+        plt.close()
+    
+    return buf.getvalue()
+
+
+def load_project_state(project_name):
+    """Возвращает (info, G, pos, paths) проекта. Вызывать под блокировкой проекта"""
+    state = project_states.get(project_name)
+    if state is not None:
+        return state
+    
+    project_dir = os.path.join(OUTPUT_DIR, project_name)
+    with open(os.path.join(project_dir, 'info.json'), 'r', encoding='utf-8') as f:
+        info = json.load(f)
+    
+    # Старые проекты без graph.json отдают только готовые кадры с диска
+    G = pos = paths = None
+    graph_file = os.path.join(project_dir, GRAPH_FILE)
+    if os.path.exists(graph_file):
+        with open(graph_file, 'r', encoding='utf-8') as f:
+            graph_state = json.load(f)
+        G, pos = build_graph(graph_state)
+        paths = graph_state['paths']
+    
+    state = (info, G, pos, paths)
+    project_states[project_name] = state
+    return state
+
+
 @app.route('/api/generate', methods=['POST'])
 def generate_animation():
     try:
@@ -24,6 +231,9 @@ def generate_animation():
         graph_data = data.get('graphData')
         start_node = data.get('startNode', 'A')
         end_node = data.get('endNode', 'H')
+        # lazy: сохраняем только манифест, кадры рисуются по запросу
+        lazy = bool(data.get('lazy', False))
+        persist_frames = bool(data.get('persistFrames', False))
         
         if not graph_data:
             return jsonify({'success': False, 'error': 'Нет данных графа'}), 400
@@ -39,24 +249,8 @@ def generate_animation():
         # Создаём временный скрипт для генерации с параметрами
         output_dir = f'output/{project_name}'
         
-        # Импортируем и запускаем генератор напрямую
-        import networkx as nx
-        import matplotlib
-        matplotlib.use('Agg')  # Без GUI
-        import matplotlib.pyplot as plt
-        
         # Создаём граф
-        G = nx.DiGraph()
-        edges = [(edge['from'], edge['to']) for edge in graph_data['edges']]
-        G.add_edges_from(edges)
-        
-        # Позиции
-        pos = {}
-        for node in graph_data['nodes']:
-            label = node['label']
-            x = node['x']
-            y = -node['y']
-            pos[label] = (x, y)
+        G, pos = build_graph(graph_data)
         
         # Находим пути
         if start_node not in G.nodes() or end_node not in G.nodes():
@@ -76,98 +270,100 @@ def generate_animation():
         # Создаём выходную директорию
         os.makedirs(output_dir, exist_ok=True)
         
-        # Генерируем кадры
-        frame_number = 0
-        all_frames = []
+        all_frames = build_frames(paths)
         
-        for path_idx, path in enumerate(paths, 1):
-            for step in range(1, len(path) + 1):
-                frame_number += 1
-                
-                current_path = path[:step]
-                current_edges = list(zip(current_path[:-1], current_path[1:])) if len(current_path) > 1 else []
-                current_edges_set = set(current_edges)
-                
-                plt.figure(figsize=(14, 8))
-                
-                other_edges = [edge for edge in G.edges() if edge not in current_edges_set]
-                other_nodes = [node for node in G.nodes() if node not in current_path]
-                
-                # Рёбра (сначала)
-                if other_edges:
-                    nx.draw_networkx_edges(G, pos, edgelist=other_edges,
-                                          edge_color='gray', width=2.5, alpha=0.4,
-                                          arrows=True, arrowsize=20, arrowstyle='->')
-                
-                if current_edges:
-                    nx.draw_networkx_edges(G, pos, edgelist=current_edges,
-                                          edge_color='#FF1744', width=5,
-                                          arrows=True, arrowsize=30, arrowstyle='->',
-                                          node_size=1500)
-                
-                # Вершины (поверх)
-                if other_nodes:
-                    nx.draw_networkx_nodes(G, pos, nodelist=other_nodes,
-                                          node_color='lightgray', node_size=1500, alpha=0.5)
-                
-                if len(current_path) > 1:
-                    intermediate = current_path[:-1]
-                    nx.draw_networkx_nodes(G, pos, nodelist=intermediate,
-                                          node_color='orange', node_size=1500,
-                                          edgecolors='#ff8c00', linewidths=3)
-                
-                current_node = current_path[-1]
-                nx.draw_networkx_nodes(G, pos, nodelist=[current_node],
-                                      node_color='#ff4500', node_size=1800,
-                                      edgecolors='#ff0000', linewidths=4)
-                
-                nx.draw_networkx_labels(G, pos, font_size=16, font_weight='bold', font_color='#333')
-                
-                title = f'Путь {path_idx}/{len(paths)} | Шаг {step}/{len(path)}: {" → ".join(current_path)}'
-                plt.title(title, fontsize=18, fontweight='bold', pad=20)
-                plt.axis('off')
-                plt.tight_layout()
-                
-                filename = f'frame_{frame_number:04d}.png'
-                filepath = os.path.join(output_dir, filename)
-                plt.savefig(filepath, dpi=150, bbox_inches='tight', facecolor='white')
-                plt.close()
-                
-                all_frames.append({
-                    'number': frame_number,
-                    'path_index': path_idx,
-                    'step': step,
-                    'current_path': ' → '.join(current_path),
-                    'filename': filename
-                })
-        
-        # Сохраняем info.json
-        info_file = os.path.join(output_dir, 'info.json')
-        with open(info_file, 'w', encoding='utf-8') as f:
-            json.dump({
-                'project_name': project_name,
-                'created': datetime.now().isoformat(),
-                'total_paths': len(paths),
-                'total_frames': frame_number,
-                'animation_type': 'progressive',
-                'paths': [' → '.join(path) for path in paths],
-                'frames': all_frames,
-                'source_json': json_file,
-                'start_node': start_node,
-                'end_node': end_node
-            }, f, ensure_ascii=False, indent=2)
+        # Пока проект перезаписывается, кадры по запросу ждут на блокировке
+        with get_project_lock(project_name):
+            # Старые кадры не должны отдаваться вместо новых
+            remove_stale_frames(output_dir, 0 if lazy else len(all_frames))
+            
+            # Генерируем кадры
+            if not lazy:
+                for frame in all_frames:
+                    filepath = os.path.join(output_dir, frame['filename'])
+                    write_file_atomic(filepath, render_frame(G, pos, paths, frame))
+            
+            # Сохраняем граф и пути для отрисовки кадров по запросу
+            graph_file = os.path.join(output_dir, GRAPH_FILE)
+            with open(graph_file, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'nodes': graph_data['nodes'],
+                    'edges': graph_data['edges'],
+                    'paths': paths
+                }, f, ensure_ascii=False, indent=2)
+            
+            # Сохраняем info.json
+            info_file = os.path.join(output_dir, 'info.json')
+            with open(info_file, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'project_name': project_name,
+                    'created': datetime.now().isoformat(),
+                    'total_paths': len(paths),
+                    'total_frames': len(all_frames),
+                    'animation_type': 'progressive',
+                    'lazy': lazy,
+                    'persist_frames': persist_frames,
+                    'paths': [' → '.join(path) for path in paths],
+                    'frames': all_frames,
+                    'source_json': json_file,
+                    'start_node': start_node,
+                    'end_node': end_node
+                }, f, ensure_ascii=False, indent=2)
+            
+            # Новое состояние записано — сбрасываем закэшированное
+            project_states.pop(project_name, None)
+            frame_cache.drop_project(project_name)
         
         return jsonify({
             'success': True,
             'projectName': project_name,
-            'totalFrames': frame_number,
+            'totalFrames': len(all_frames),
             'totalPaths': len(paths),
+            'lazy': lazy,
             'outputDir': output_dir
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/projects/<name>/frames/<int:number>', methods=['GET'])
+def get_frame(name, number):
+    """Кадр проекта: с диска, из LRU-кэша или отрисованный по запросу"""
+    try:
+        if name != os.path.basename(name) or name in ('', '.', '..'):
+            return jsonify({'error': 'Некорректное имя проекта'}), 400
+        
+        project_dir = os.path.join(OUTPUT_DIR, name)
+        if not os.path.exists(os.path.join(project_dir, 'info.json')):
+            return jsonify({'error': f'Проект {name} не найден'}), 404
+        
+        with get_project_lock(name):
+            info, G, pos, paths = load_project_state(name)
+            if number < 1 or number > info.get('total_frames', 0):
+                return jsonify({'error': f'Кадр {number} не найден'}), 404
+            
+            filename = f'frame_{number:04d}.png'
+            filepath = os.path.join(project_dir, filename)
+            if os.path.exists(filepath):
+                return send_file(os.path.abspath(filepath), mimetype='image/png')
+            
+            key = (name, number)
+            data = frame_cache.get(key)
+            if data is None:
+                if G is None:
+                    return jsonify({'error': f'Кадр {number} не найден'}), 404
+                
+                data = render_frame(G, pos, paths, info['frames'][number - 1])
+                frame_cache.put(key, data)
+                
+                if info.get('persist_frames') or request.args.get('persist') == '1':
+                    write_file_atomic(filepath, data)
+        
+        return send_file(io.BytesIO(data), mimetype='image/png')
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/projects', methods=['GET'])
 def list_projects():
     """Список всех проектов"""
@@ -188,7 +384,8 @@ def list_projects():
                             'name': item,
                             'created': info.get('created'),
                             'totalFrames': info.get('total_frames', 0),
-                            'totalPaths': info.get('total_paths', 0)
+                            'totalPaths': info.get('total_paths', 0),
+                            'lazy': info.get('lazy', False)
                         })
         
         # Сортируем по дате создания
@@ -207,6 +404,7 @@ if __name__ == '__main__':
     print("API endpoints:")
     print("  POST /api/generate - Генерация анимации")
     print("  GET  /api/projects - Список проектов")
+    print("  GET  /api/projects/<name>/frames/<n> - Кадр (отрисовка по запросу)")
     print("=" * 50)
     
     app.run(host='0.0.0.0', port=5000, debug=True)